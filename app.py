@@ -1,19 +1,24 @@
 import streamlit as st
-import json
+import atexit
 import os
 import uuid
 import hashlib
+import hmac
 import io
 import re
+import queue
+import threading
+import time
+import httpx
+import orjson
+from collections import ChainMap, deque
+from concurrent.futures import ThreadPoolExecutor
+from types import MappingProxyType
 from datetime import datetime
 from openai import OpenAI
 from supabase import create_client, Client
-from docx import Document
-from docx.shared import Pt, Inches
-from docx.enum.text import WD_ALIGN_PARAGRAPH
-from docx.oxml.ns import qn
-from groq import Groq
-from pypdf import PdfReader
+from xml.sax.saxutils import escape
+# docx / pypdf / groq 只在导出、读文件、转写时才用到，放到各自函数里按需导入，纯聊天的冷启动不必加载 lxml 等重模块
 # --- 新增：录音组件库 ---
 from streamlit_mic_recorder import mic_recorder
 
@@ -36,7 +41,9 @@ hide_streamlit_style = """
     @media (max-width: 640px) {.block-container {padding-left: 1rem; padding-right: 1rem;}}
 </style>
 """
-st.markdown(hide_streamlit_style, unsafe_allow_html=True)
+@st.cache_data(show_spinner=False)
+def page_css(): return hide_streamlit_style.strip()
+st.markdown(page_css(), unsafe_allow_html=True)
 
 # ==========================================
 # 2. 全局常量
@@ -46,6 +53,20 @@ SUPABASE_KEY = st.secrets.get("SUPABASE_KEY", "")
 GROQ_API_KEY = st.secrets.get("GROQ_API_KEY", "")
 DEFAULT_BASE_URL = "https://api.deepseek.com"
 DEFAULT_MODEL = "deepseek-chat"
+HISTORY_WINDOW = 20  # 每次请求携带的最近消息条数
+HISTORY_CHAR_BUDGET = 24000  # 携带历史的总字数上限，条数没满但消息很长时再往前截
+SUMMARY_CHAR_BUDGET = 48000  # 研讨会纪要一次送去总结的对话总字数上限
+SUMMARY_CHUNK_CHARS = 16000  # 超出上限的早期讨论按这么多字一段分别提炼要点
+MULTI_AGENT_MAX_TOKENS = 8192  # 多智能体一次输出初稿 + 审稿 + 完整定稿，用足 deepseek-chat 的输出上限
+AI_MEMO_MAX = 32  # 每个会话记住的大纲/精修结果条数
+REFINE_SUMMARY_AFTER = 2  # 同一版本剧本精修超过这么多次后才改用摘要做背景
+SCRIPT_SUMMARY_HEAD, SCRIPT_SUMMARY_TAIL = 2000, 500  # 生成摘要时只送剧本开头/结尾这么多字
+RENDER_WINDOW = 50  # 对话区一次渲染的最近消息条数
+STREAM_FLUSH_SECS = 0.05  # 手写流式输出最短刷新间隔 (秒)
+STREAM_FLUSH_CHUNKS = 16  # 或攒够这么多分片就刷新一次
+SESSION_PAGE = 50  # 侧边栏默认列出的最近会话数
+DB_BATCH_MAX = 32  # 后台写库每批最多合并的写操作数
+DB_BATCH_WAIT = 0.2  # 第一条写操作到达后最多再等多少秒攒批
 
 # 剧本格式规则 (保持原样)
 SCRIPT_STYLE_GUIDE = """
@@ -67,12 +88,20 @@ SCRIPT_STYLE_GUIDE = """
 3. 情感层次：善于从潜台词中展示冲突，不要直白喊出来。
 """
 
-# 普通对话人设 (保持原样)
-DEFAULT_PERSONAS = {
+# 多智能体：起草、审稿、重写在一次请求里完成，按标签分段输出，页面上只流式显示 <final> 段
+MULTI_AGENT_GUIDE = SCRIPT_STYLE_GUIDE + """
+本次请依次完成三步，并严格用标签分段输出，标签外不要有任何内容：
+<draft>按要求写出的初稿，只写分场梗概和关键台词，控制在 800 字以内</draft>
+<critique>以毒舌审稿人的身份，一针见血地指出初稿的问题，列 3-5 条，每条一句话</critique>
+<final>根据审稿意见重写后的完整剧本</final>
+"""
+
+# 普通对话人设 (保持原样)，只读，用户自定义的人设另存
+DEFAULT_PERSONAS = MappingProxyType({
 	"默认-知心老友":"你是我无话不谈的创意搭档。请用自然、口语化、直率的语气和我对话。严禁使用括号描写动作，直接说话。**重要：请时刻跟随用户最新的话题，不要反复纠结于用户之前提到的旧话题**。",
     "模式-严厉导师":"你是一位在好莱坞拥有30年经验的严厉编剧导师。不要说客套话，不要盲目鼓励。你需要一针见血地指出用户灵感中的逻辑漏洞、陈词滥调和人物动机不合理之处。说话风格：犀利、专业、不留情面，提出的建议必须具有建设性。",
     "模式-苏格拉底":"你是一个只会提问的哲学家，通过提出层层递进的问题引导用户自己发现答案，或者发现自己思维中的盲区。",
-}
+})
 
 # 研讨会专用 System Prompt (保持原样)
 SEMINAR_SYSTEM_PROMPT = """
@@ -124,7 +153,14 @@ SEMINAR_SYSTEM_PROMPT = """
 @st.cache_resource
 def init_supabase():
     if not SUPABASE_URL or not SUPABASE_KEY: return None
-    return create_client(SUPABASE_URL, SUPABASE_KEY)
+    # 超时沿用库的默认值 (PostgREST 120 秒)：长会话整段 upsert 的请求体可能很大，后台写入不在页面关键路径上，不必卡得太紧
+    sb = create_client(SUPABASE_URL, SUPABASE_KEY)
+    # PostgREST 会话换成调过参数的 HTTP/2 长连接池 (与 OpenAI 客户端同规格)，沿用原会话的地址、鉴权头与超时
+    old = sb.postgrest.session
+    sb.postgrest.session = httpx.Client(base_url=old.base_url, headers=old.headers, timeout=old.timeout, follow_redirects=old.follow_redirects, http2=True, limits=httpx.Limits(max_keepalive_connections=20, max_connections=40)); old.close()
+    return sb
+
+SB = init_supabase()
 
 # ==========================================
 # 3. 工具函数
@@ -134,30 +170,42 @@ def extract_text_from_file(uploaded_file):
     try:
         if uploaded_file.type == "text/plain": content = uploaded_file.read().decode("utf-8")
         elif uploaded_file.type == "application/pdf":
-            reader = PdfReader(uploaded_file); 
-            for page in reader.pages: content += page.extract_text() + "\n"
+            # 逐页/逐段生成后一次 join，不再反复拼接大字符串；extract_text() 对扫描页可能返回 None
+            from pypdf import PdfReader
+            content = "".join((page.extract_text() or "") + "\n" for page in PdfReader(uploaded_file).pages)
         elif "word" in uploaded_file.type:
-            doc = Document(uploaded_file); 
-            for para in doc.paragraphs: content += para.text + "\n"
+            from docx import Document
+            content = "".join(para.text + "\n" for para in Document(uploaded_file).paragraphs)
     except Exception as e: return f"读取失败: {str(e)}"
     return content
 
+# 与 OpenAI 客户端一样进程内只建一个 Groq 客户端，转写请求复用它的连接池
+@st.cache_resource
+def get_groq_client(api_key):
+    from groq import Groq
+    return Groq(api_key=api_key)
+
+# 同一份音视频再次上传时按内容摘要命中缓存，不必重新走一遍 Whisper；转写失败会抛出异常，不会被缓存
+@st.cache_data(ttl=86400, max_entries=16, show_spinner=False)
+def _transcribe_cached(digest, _uploaded_file):
+    _uploaded_file.name = "audio.mp3"; _uploaded_file.seek(0)
+    # 直接把上传文件对象交给 SDK 组 multipart，不再先 read() 复制出一份完整的音频字节
+    return get_groq_client(GROQ_API_KEY).audio.transcriptions.create(
+        file=(_uploaded_file.name, _uploaded_file),
+        model="whisper-large-v3", response_format="text"
+    )
+
 # 原始的文件转录函数 (用于研讨会模式上传文件)
 def transcribe_audio(uploaded_file):
     if not GROQ_API_KEY: return "❌ 请配置 GROQ_API_KEY"
-    client = Groq(api_key=GROQ_API_KEY)
-    try:
-        uploaded_file.name = "audio.mp3"
-        return client.audio.transcriptions.create(
-            file=(uploaded_file.name, uploaded_file.read()),
-            model="whisper-large-v3", response_format="text"
-        )
+    # getbuffer() 直接在上传缓冲区上算摘要，不复制音频字节
+    try: return _transcribe_cached(hashlib.blake2b(uploaded_file.getbuffer(), digest_size=16).hexdigest(), uploaded_file)
     except Exception as e: return f"转录失败: {str(e)}"
 
 # --- 新增：麦克风录音转录函数 (处理 raw bytes) ---
 def transcribe_mic(audio_bytes):
     if not GROQ_API_KEY: return "❌ 请配置 GROQ_API_KEY (Secrets)"
-    client = Groq(api_key=GROQ_API_KEY)
+    client = get_groq_client(GROQ_API_KEY)
     try:
         # Whisper 需要文件名，这里模拟一个
         return client.audio.transcriptions.create(
@@ -167,98 +215,370 @@ def transcribe_mic(audio_bytes):
         )
     except Exception as e: return f"转录失败: {str(e)}"
 
-def set_courier_font(run, size=12):
-    run.font.name = 'Courier New'; run._element.rPr.rFonts.set(qn('w:eastAsia'), 'Courier New'); run.font.size = Pt(size)
+SCENE_RE = re.compile(r"第一幕|INT\.|EXT\.|内\.|外\.")  # 场景标题关键词
+DIALOG_SPLIT_RE = re.compile(r"[：:]")  # 角色名与台词的分隔符
+
+# 每行只判定一次类型 (标题/场景/动作/对白/普通)，对白顺带返回切好的角色名和台词，再按类型套用对应的段落模板
+def classify_line(line):
+    if line.startswith("《") and line.endswith("》"): return "title", None
+    if SCENE_RE.search(line) or (len(line)<15 and "点" in line and "分" in line): return "scene", None
+    if line.startswith("（") and line.endswith("）"): return "action", None
+    parts = DIALOG_SPLIT_RE.split(line, 1)
+    if len(parts)==2: return ("dialog", parts) if len(parts[0].strip())<15 else ("plain", None)
+    return "other", None
+# 各类行对应的段落 OXML 模板 (间距单位 1/20 磅，字号单位半磅，缩进单位 1/1440 英寸)；字体与 12 磅字号由 Normal 样式统一提供
+_T = '<w:t xml:space="preserve">{%d}</w:t>'
+DOCX_P = {
+    "title": '<w:p><w:pPr><w:spacing w:after="480"/><w:jc w:val="center"/></w:pPr><w:r><w:rPr><w:b/><w:sz w:val="32"/></w:rPr>' + _T % 0 + '</w:r></w:p>',
+    "scene": '<w:p><w:pPr><w:keepNext/><w:spacing w:before="360" w:after="120"/></w:pPr><w:r><w:rPr><w:b/></w:rPr>' + _T % 0 + '</w:r></w:p>',
+    "action": '<w:p><w:pPr><w:spacing w:after="120"/><w:ind w:left="0"/></w:pPr><w:r>' + _T % 0 + '</w:r></w:p>',
+    # 对白：空行 + 居中加粗的角色名 + 左右各缩进 1.5 英寸的台词
+    "dialog": '<w:p/><w:p><w:pPr><w:keepNext/><w:spacing w:before="240"/><w:jc w:val="center"/></w:pPr><w:r><w:rPr><w:b/></w:rPr>' + _T % 0 + '</w:r></w:p>'
+              '<w:p><w:pPr><w:ind w:left="2160" w:right="2160"/></w:pPr><w:r>' + _T % 1 + '</w:r></w:p>',
+    "plain": '<w:p><w:r>' + _T % 0 + '</w:r></w:p>',
+    "other": '<w:p><w:pPr><w:spacing w:after="120"/></w:pPr><w:r>' + _T % 0 + '</w:r></w:p>',
+}
+def docx_line_xml(line):
+    kind, parts = classify_line(line); return DOCX_P[kind].format(*(escape(x.strip()) for x in (parts or (line,))))
 
+# 按剧本内容缓存生成好的 docx 字节，内容不变时 rerun 不再重新排版
+# Courier New (含东亚字体) 与 12 磅字号统一设在 Normal 样式上，每个 run 默认继承，不必逐个设置
+# 正文按模板拼成一整段 OXML 字符串，一次解析后插到分节属性 (sectPr) 之前，不再逐段 add_paragraph/add_run
+@st.cache_data(max_entries=8, show_spinner=False)
 def create_docx(script_content):
-    doc = Document(); style = doc.styles['Normal']; style.font.name = 'Courier New'; style.font.size = Pt(12)
-    lines = script_content.split('\n')
-    for line in lines:
-        line = line.strip()
-        if not line: continue
-        p = doc.add_paragraph(); run = p.add_run(line); set_courier_font(run)
-        if line.startswith("《") and line.endswith("》"):
-            p.alignment = WD_ALIGN_PARAGRAPH.CENTER; run.bold=True; run.font.size=Pt(16); p.paragraph_format.space_after=Pt(24)
-        elif any(k in line for k in ["第一幕", "INT.", "EXT.", "内.", "外."]) or (len(line)<15 and "点" in line and "分" in line):
-            run.bold=True; p.paragraph_format.space_before=Pt(18); p.paragraph_format.space_after=Pt(6); p.paragraph_format.keep_with_next=True
-        elif line.startswith("（") and line.endswith("）"):
-            p.paragraph_format.left_indent=Inches(0.0); p.paragraph_format.space_after=Pt(6)
-        elif "：" in line or ":" in line:
-            parts = re.split(r"[：:]", line, 1)
-            if len(parts)==2 and len(parts[0].strip())<15:
-                p.clear(); p_role=doc.add_paragraph(); p_role.alignment=WD_ALIGN_PARAGRAPH.CENTER; r_role=p_role.add_run(parts[0].strip()); set_courier_font(r_role); r_role.bold=True; p_role.paragraph_format.space_before=Pt(12); p_role.paragraph_format.keep_with_next=True
-                p_dial=doc.add_paragraph(); p_dial.paragraph_format.left_indent=Inches(1.5); p_dial.paragraph_format.right_indent=Inches(1.5); r_dial=p_dial.add_run(parts[1].strip()); set_courier_font(r_dial)
-        else: p.paragraph_format.space_after=Pt(6)
-    buffer = io.BytesIO(); doc.save(buffer); buffer.seek(0)
-    return buffer
+    from docx import Document; from docx.shared import Pt; from docx.oxml import parse_xml; from docx.oxml.ns import qn, nsdecls
+    doc = Document(); style = doc.styles['Normal']; style.font.name = 'Courier New'; style.font.size = Pt(12); style.element.rPr.rFonts.set(qn('w:eastAsia'), 'Courier New')
+    xml = "".join(docx_line_xml(line) for line in map(str.strip, script_content.splitlines()) if line)
+    body = doc.element.body; sect = body.sectPr; put = sect.addprevious if sect is not None else body.append
+    for p in list(parse_xml(f'<w:body {nsdecls("w")}>{xml}</w:body>')): put(p)
+    buffer = io.BytesIO(); doc.save(buffer)
+    return buffer.getvalue()
+
+# 对话/研讨共用的历史渲染：消息追加后内容不再变化，逐条输出相同的 markdown，前端按内容对比即可跳过未变的气泡
+# 只渲染最近 RENDER_WINDOW 条，更早的点按钮按页展开；展开的条数按会话记在 session_state 里
+def render_history(sid, msgs):
+    shown = st.session_state.setdefault("_shown", {}); n = shown.get(sid, RENDER_WINDOW)
+    if len(msgs) > n and st.button(f"⬆️ 加载更早的消息 (还有 {len(msgs)-n} 条)", key=f"more_{sid}"): n = shown[sid] = n + RENDER_WINDOW
+    for m in msgs[-n:]:
+        with st.chat_message(m["role"]): st.markdown(m["content"])
 
 def stream_parser(stream):
     for chunk in stream:
         if chunk.choices[0].delta.content is not None: yield chunk.choices[0].delta.content
 
+# 流式输出的同时把分片收进列表；结束 (包括中途断流) 后一次 join 成助手消息并写库，已显示的内容不会丢
+def stream_reply(strm, sess, sid, u):
+    parts = []
+    def collect():
+        for c in stream_parser(strm): parts.append(c); yield c
+    try: st.write_stream(collect())
+    finally:
+        if parts: sess["messages"].append({"role": "assistant", "content": "".join(parts)}); append_message_db(sid, sess, u)
+
+# 只取出 <tag>…</tag> 之间的内容继续往下流；标签可能被切在两个分片之间，所以边界附近留一小段再判断。
+# 没有这一段或没写完 (如输出被长度上限截断) 时抛出 ValueError，调用方不要把半截内容或草稿标签当成结果保存
+def tagged_section(chunks, tag):
+    start, end = f"<{tag}>", f"</{tag}>"; buf = ""; inside = False
+    for c in chunks:
+        buf += c
+        if not inside:
+            i = buf.find(start)
+            if i < 0: buf = buf[-len(start):]; continue
+            inside = True; buf = buf[i+len(start):]
+        j = buf.find(end)
+        if j >= 0:
+            if buf[:j]: yield buf[:j]
+            return
+        if len(buf) >= len(end): yield buf[:1-len(end)]; buf = buf[1-len(end):]
+    if inside: yield buf
+    raise ValueError(f"输出中缺少完整的 {start} 段落")
+
+# 文章/剧本的流式输出：分片全部收进列表，隔一小段时间或攒够一批才 join 一次刷新占位框，不再每个 token 重新渲染整段 markdown
+def stream_to_box(strm, section=None):
+    bx = st.empty(); parts = []; n = 0; last = time.monotonic()
+    chunks = stream_parser(strm)
+    try:
+        for c in tagged_section(chunks, section) if section else chunks:
+            parts.append(c)
+            if len(parts) - n >= STREAM_FLUSH_CHUNKS or time.monotonic() - last > STREAM_FLUSH_SECS: bx.markdown("".join(parts)+"▌"); n = len(parts); last = time.monotonic()
+    finally: ft = "".join(parts); bx.markdown(ft)  # 中途出错也把已收到的内容留在框里，去掉光标
+    return ft
+
 # ==========================================
 # 4. 身份与数据
 # ==========================================
-def hash_password(p): return hashlib.sha256(p.encode()).hexdigest()
+# 进程内共用的后台线程池：研讨纪要分段提炼等不必阻塞页面的 AI 调用
+@st.cache_resource
+def get_worker_pool(): return ThreadPoolExecutor(max_workers=4)
+# 登录时并行查库单独用一个小线程池，不会排在几秒到几十秒的 AI 调用后面
+@st.cache_resource
+def get_db_read_pool(): return ThreadPoolExecutor(max_workers=4, thread_name_prefix="db-read")
+# 口令存为 "scrypt$盐$摘要"，盐随口令一起保存；旧账号的裸 sha256 摘要仍可登录，登录成功后自动升级
+def hash_password(pw, salt=None):
+    salt = salt or os.urandom(16).hex(); return f"scrypt${salt}${hashlib.scrypt(pw.encode(), salt=bytes.fromhex(salt), n=2**14, r=8, p=1).hex()}"
+def check_password(pw, stored):
+    if stored.startswith("scrypt$"): return hmac.compare_digest(stored, hash_password(pw, stored.split("$")[1]))
+    return hmac.compare_digest(stored, hashlib.sha256(pw.encode()).hexdigest())
 def register_user(u, p):
-    sb = init_supabase(); 
-    if not sb: return False, "DB未配"
-    if sb.table("users").select("*").eq("username", u).execute().data: return False, "存在"
-    try: sb.table("users").insert({"username": u, "password": hash_password(p), "personas": {}}).execute(); return True, "成功"
-    except Exception as e: return False, str(e)
+    if not SB: return False, "DB未配"
+    # 直接插入，由 username 唯一约束判重 (冲突时 PostgREST 返回 23505)，不再先查一次
+    try: SB.table("users").insert({"username": u, "password": hash_password(p), "personas": {}}, returning="minimal").execute(); return True, "成功"
+    except Exception as e: return False, "存在" if getattr(e, "code", None) == "23505" else str(e)
 def login_user(u, p=None):
-    sb = init_supabase(); 
-    if not sb: return False, {}
-    try:
-        q = sb.table("users").select("*").eq("username", u)
-        if p: q = q.eq("password", hash_password(p))
-        res = q.execute()
-        return (True, res.data[0]) if res.data else (False, {})
-    except: return False, {}
-def update_user_personas(u, p): sb=init_supabase(); sb and sb.table("users").update({"personas": p}).eq("username", u).execute()
+    if not SB: return False, {}
+    # 一次往返同时取回用户、口令摘要与全部会话 (get_user_bundle 见 supabase.sql)，只按用户名查，口令在本地比对；
+    # p 为空时为 URL 自动登录，用不到口令摘要，也就不让它再传回客户端
+    try: d = SB.rpc("get_user_bundle", {"uname": u, "with_password": bool(p)}).execute().data; bundled = True
+    except: bundled = False
+    # 数据库未部署 (或仍是旧版) get_user_bundle 时按用户名单独查用户，同时在后台线程并行拉会话列表，省掉一次串行往返；登录失败就丢弃
+    sessions = None
+    if not bundled or (p and d and "password" not in d):
+        sessions = get_db_read_pool().submit(load_user_data, u)
+        try: res = SB.table("users").select("username,password,personas" if p else "username,personas").eq("username", u).maybe_single().execute(); d = res.data if res else None  # 无此用户时部分版本直接返回 None
+        except: return False, {}
+    if not d: return False, {}
+    stored = d.pop("password", None) or ""
+    if p:
+        if not check_password(p, stored): return False, {}
+        if not stored.startswith("scrypt$"):
+            try: SB.table("users").update({"password": hash_password(p)}).eq("username", u).execute()
+            except: pass
+    if "sessions" not in d: d["sessions"] = sessions.result() if sessions else load_user_data(u)
+    return True, d
+# 写库后按用户 ("u", 用户名) / 会话 ("s", id) 递增的版本号，作为读缓存键的一部分：
+# 只有被写过的用户/会话才会重新查询，其他用户的缓存不受影响
+@st.cache_resource
+def get_data_versions(): return {}
+DATA_VER = get_data_versions()
+# 短时缓存：退出后马上重新登录不必再拉一遍会话；查询失败会抛出异常，不会被缓存
+# 列表只取 id/标题/创建时间，会话全文 (消息、文章、剧本) 等第一次打开时再单独加载
+@st.cache_data(ttl=60, max_entries=32, show_spinner=False)
+def _fetch_user_sessions(u, ver): res=SB.table("chat_history").select("id,title:data->>title,created_at:data->>created_at").eq("username", u).order("data->>created_at", desc=True).execute(); return {r['id']: {"title": r['title'], "created_at": r['created_at']} for r in res.data or ()}
+@st.cache_data(ttl=60, max_entries=64, show_spinner=False)
+def _fetch_session(sid, ver): return SB.table("chat_history").select("data").eq("id", sid).single().execute().data["data"]
 def load_user_data(u):
-    sb=init_supabase()
-    if not sb: return {}
-    try: res=sb.table("chat_history").select("*").eq("username", u).execute(); return {r['id']: r['data'] for r in res.data}
+    if not SB: return {}
+    try: return _fetch_user_sessions(u, DATA_VER.get(("u", u), 0))
     except: return {}
+SESSION_FIELDS = ("article_content", "script_content", "outline_content", "extracted_material", "extracted_analysis")
+# 旧会话缺的字段补成空串；返回是否补过，补过的会话写回一次库，以后再加载就是完整的
+def fill_session_fields(s):
+    missing = [k for k in SESSION_FIELDS if k not in s]
+    for k in missing: s[k]=""
+    return s, bool(missing)
+# history 里未打开过的会话只有标题 (没有 messages)，取用前补全；加载失败直接停下，免得把空会话写回库里
+def get_session(sid):
+    s = st.session_state.history[sid]
+    if "messages" not in s:
+        try: s, fixed = fill_session_fields(_fetch_session(sid, DATA_VER.get(("s", sid), 0)))
+        except: st.error("会话加载失败，请刷新重试"); st.stop()
+        st.session_state.history[sid] = s
+        if fixed: save_session_db(sid, s, st.session_state.current_user)
+        else: st.session_state.setdefault("_saved", {})[sid] = {k: _digest(v) for k, v in _snapshot(s).items()}  # 记下库里的现状，之后只改个别字段时可以只发这几个字段
+    return s
+
+# --- 后台写库：写操作进队列，由守护线程顺序执行，不阻塞页面 ---
+# 每次取出队列里积压的全部写操作再合并：相邻的 upsert 并成一次批量 upsert (同一会话只留最新)，同一会话相邻的追加并成一次 RPC
+# 同一用户相邻的人设更新只留最新；人设更新与该用户的会话 upsert 相邻时并成一次 save_user_bundle RPC，在一个事务里写完
+# 按函数名比较，因为每次 rerun 都会重新定义这些函数
+def _own_rows(u, rows): return all(r["username"] == u for r in rows.values())
+def _coalesce(batch):
+    out = []
+    for fn, args in batch:
+        prev = out[-1] if out else None; a, b = prev and prev[0].__name__, fn.__name__
+        if a == b == "_upsert_sessions": prev[1][0].update(args[0])
+        elif a == b == "_append_messages" and prev[1][0] == args[0]: out[-1] = (fn, (args[0], prev[1][1] + args[1], args[2], args[3]))
+        elif a == b == "_patch_session" and prev[1][0] == args[0]: out[-1] = (fn, (args[0], {**prev[1][1], **args[1]}, args[2], args[3]))
+        elif a in ("_update_personas", "_save_user_bundle") and b == "_update_personas" and prev[1][0] == args[0]: out[-1] = (prev[0], args + prev[1][2:])
+        elif a == "_update_personas" and b == "_upsert_sessions" and _own_rows(prev[1][0], args[0]): out[-1] = (_save_user_bundle, (*prev[1], args[0]))
+        elif a == "_upsert_sessions" and b == "_update_personas" and _own_rows(args[0], prev[1][0]): out[-1] = (_save_user_bundle, (*args, prev[1][0]))
+        elif a == "_save_user_bundle" and b == "_upsert_sessions" and _own_rows(prev[1][0], args[0]): prev[1][2].update(args[0])
+        else: out.append((fn, args))
+    return out
+# 一次写操作会改到哪些用户的会话列表、哪些会话的全文 (追加消息不改标题，不影响列表)
+def _touched(fn, args):
+    n = fn.__name__
+    if n == "_append_messages": return [("s", args[0])]
+    if n == "_delete_sessions": return [("u", args[1])] + [("s", s) for s in args[0]]
+    if n == "_patch_session": return [("s", args[0])] + ([("u", args[3])] if "title" in args[1] else [])
+    rows = args[0] if n == "_upsert_sessions" else args[2] if n == "_save_user_bundle" else {}
+    return [("u", r["username"]) for r in rows.values()] + [("s", s) for s in rows]
+def _drain_db_writes(q):
+    while True:
+        # 第一条到达后再等一小会儿攒批，连续几轮保存 (如一问一答) 就能合并成一次请求
+        batch = [q.get()]; end = time.monotonic() + DB_BATCH_WAIT
+        while len(batch) < DB_BATCH_MAX and (left := end - time.monotonic()) > 0:
+            try: batch.append(q.get(timeout=left))
+            except queue.Empty: break
+        for fn, args in _coalesce(batch):
+            try: fn(*args)
+            except: FAILED_WRITES.update(k[1] for k in _touched(fn, args) if k[0] == "s")  # 记下写失败的会话，下次保存改为整段 upsert 补上
+            for k in _touched(fn, args): DATA_VER[k] = DATA_VER.get(k, 0) + 1  # 写完后让相关的读缓存失效
+        for _ in batch: q.task_done()
+@st.cache_resource
+def get_db_writer():
+    q = queue.Queue(); threading.Thread(target=_drain_db_writes, args=(q,), daemon=True).start()
+    # 写线程是守护线程，进程退出 (重新部署、停机) 前先等队列里已排队的写入落库，不丢最后几轮对话；每次写入都有超时，不会卡住退出
+    atexit.register(q.join)
+    return q
+# 后台写入失败的会话 id：写线程拿不到 session_state，只能记在进程共享的集合里，由下次保存时取走
+@st.cache_resource
+def get_failed_writes(): return set()
+FAILED_WRITES = get_failed_writes()
+# 与 SB 一样在脚本开头取一次缓存的写队列，写库时不必每次再走 cache_resource 查找
+DB_WRITER = get_db_writer() if SB else None
+# 整段会话用 orjson 编码后直接 POST 给 PostgREST (复用 supabase 客户端的会话与鉴权头)，不走 httpx 内部的 json.dumps
+def _upsert_sessions(rows): SB.postgrest.session.post("/chat_history", content=orjson.dumps(list(rows.values())), headers={"Content-Type": "application/json", "Prefer": "resolution=merge-duplicates,return=minimal"}).raise_for_status()
+def _session_row(sid, data, u): return {sid: {"id": sid, "username": u, "data": data}}
+# 追加不到 (会话行还不存在，如首次整段写入失败) 或数据库未部署该函数时退回整段 upsert，不会悄悄丢掉之后的每一轮
+def _append_messages(sid, msgs, data, u):
+    try: ok = SB.rpc("append_messages", {"sid": sid, "uname": u, "msgs": msgs}).execute().data
+    except: ok = False
+    if not ok: _upsert_sessions(_session_row(sid, data, u))
+# 只把改动过的顶层字段合并进 data (patch_session 见 supabase.sql)；会话行还不存在或数据库未部署该函数时退回整段 upsert
+def _patch_session(sid, patch, data, u):
+    try: ok = SB.rpc("patch_session", {"sid": sid, "uname": u, "patch": patch}).execute().data
+    except: ok = False
+    if not ok: _upsert_sessions(_session_row(sid, data, u))
+def _delete_sessions(sids, u): SB.table("chat_history").delete().in_("id", sids).eq("username", u).execute()
+def _update_personas(u, p): SB.table("users").update({"personas": p}).eq("username", u).execute()
+# 人设与会话一起写 (save_user_bundle 见 supabase.sql)；数据库未部署该函数时分两次写
+def _save_user_bundle(u, p, rows):
+    try: SB.rpc("save_user_bundle", {"uname": u, "pers": p, "sess": list(rows.values())}).execute()
+    except: _update_personas(u, p); _upsert_sessions(rows)
+# 入队时拍快照 (浅拷贝 + 复制消息列表)，之后 SESS 继续被修改也不影响已排队的写入
+def _snapshot(data): return {**data, "messages": list(data.get("messages", []))}
+def _digest(v): return hashlib.blake2b(orjson.dumps(v), digest_size=16).digest()
+# 该会话之前有写入失败：丢掉记下的字段摘要 (入队时就已更新，并不代表已落库)，接下来的保存按首次保存整段 upsert
+def _forget_failed(sid):
+    if sid not in FAILED_WRITES: return False
+    FAILED_WRITES.discard(sid); st.session_state.get("_saved", {}).pop(sid, None); return True
+# 记下每个会话最近一次写入时各个字段的摘要：内容完全没变 (如命中缓存的重复生成) 时不再重复写；
+# 只改了文章/大纲/剧本/标题等字段而消息没变时只发这几个字段，不再把整段消息历史重新上传
 def save_session_db(sid, data, u):
-    sb = init_supabase()
-    if sb:
-        try:
-            _ = sb.table("chat_history").upsert({"id": sid, "username": u, "data": data}).execute()
-        except:
-            pass
-def delete_session_db(sid): sb=init_supabase(); sb and sb.table("chat_history").delete().eq("id", sid).execute()
+    if not DB_WRITER: return
+    _forget_failed(sid); snap = _snapshot(data); saved = st.session_state.setdefault("_saved", {}); prev = saved.get(sid); cur = saved[sid] = {k: _digest(v) for k, v in snap.items()}
+    changed = [k for k in cur if not prev or prev.get(k) != cur[k]]
+    if not changed: return
+    if prev and "messages" not in changed and prev.keys() <= cur.keys(): DB_WRITER.put((_patch_session, (sid, {k: snap[k] for k in changed}, snap, u)))
+    else: DB_WRITER.put((_upsert_sessions, (_session_row(sid, snap, u),)))
+def append_message_db(sid, data, u, n=1):
+    # 只把最后 n 条新消息追加到 data->messages (append_messages 见 supabase.sql)，不再整段重传；失败时退回整段 upsert
+    if not DB_WRITER: return
+    if _forget_failed(sid): return save_session_db(sid, data, u)  # 之前的写入失败过，只追加这几条会在库里留下缺口，改为整段 upsert
+    snap = _snapshot(data); DB_WRITER.put((_append_messages, (sid, data["messages"][-n:], snap, u)))
+    if prev := st.session_state.get("_saved", {}).get(sid): prev["messages"] = _digest(snap["messages"])
+# 批量删除：一次 in_ 请求代替逐条 DELETE
+def delete_sessions_db(sids, u): DB_WRITER and sids and DB_WRITER.put((_delete_sessions, (list(sids), u)))
+def update_user_personas(u, p): DB_WRITER and DB_WRITER.put((_update_personas, (u, dict(p))))
 
 # ==========================================
 # 5. API 调用
 # ==========================================
+# secrets 在运行期间不会变，读一次后缓存，不必每次 rerun 都查三遍 st.secrets
+# 用 cache_resource 存一份只读单例：cache_data 每次命中都要反序列化出新的 dict 副本，这里直接返回同一个对象
+@st.cache_resource
 def get_settings():
-    return {
+    return MappingProxyType({
         "api_key": st.secrets.get("api_key", ""),
         "base_url": st.secrets.get("base_url", DEFAULT_BASE_URL),
         "model_name": st.secrets.get("model_name", DEFAULT_MODEL)
-    }
+    })
 
-def call_ai_stream(messages, settings, temperature=0.7):
-    client = OpenAI(api_key=settings["api_key"], base_url=settings["base_url"])
-    if len(messages)>20: messages=[messages[0]]+messages[-20:]
-    try: return client.chat.completions.create(model=settings["model_name"], messages=messages, stream=True, temperature=temperature)
+@st.cache_resource
+def get_openai_client(api_key, base_url):
+    # 进程内共用一个 HTTP/2 长连接池，并发请求复用同一条 TCP/TLS 连接；超时沿用 SDK 默认的 600 秒 (长剧本、大纲的非流式生成首字节可能超过一分钟)，只把建连限制在 5 秒
+    http_client = httpx.Client(http2=True, limits=httpx.Limits(max_keepalive_connections=20, max_connections=40), timeout=httpx.Timeout(600, connect=5))
+    return OpenAI(api_key=api_key, base_url=base_url, http_client=http_client)
+
+# 每个会话在 session_state 里维护最近 HISTORY_WINDOW 条消息的滚动窗口，只追加新增部分，组装请求不必再切片整段历史
+def history_tail(sid, msgs):
+    tails = st.session_state.setdefault("_tails", {})
+    tail, n = tails.get(sid, (None, 0))
+    if tail is None or n > len(msgs): tail, n = deque(maxlen=HISTORY_WINDOW), 0
+    tail.extend(msgs[n:]); tails[sid] = (tail, len(msgs))
+    return within_budget(tail, HISTORY_CHAR_BUDGET)
+
+# 按字数预算从最新一条往前取 (最新一条总会带上)，免得长消息撑爆上下文被服务端拒绝；按字数估算，不引入分词器
+def within_budget(msgs, budget):
+    out = []; used = 0
+    for m in reversed(msgs):
+        used += len(m["content"])
+        if out and used > budget: break
+        out.append(m)
+    return out[::-1]
+
+# 文章/剧本用的整段对话文本同样按会话缓存，消息增加时只拼接新增部分
+def chat_context(sid, msgs):
+    ctxs = st.session_state.setdefault("_ctxs", {})
+    txt, n = ctxs.get(sid, ("", 0))
+    if n > len(msgs): txt, n = "", 0
+    if len(msgs) > n: txt = "\n".join(([txt] if n else []) + [f"{m['role']}: {m['content']}" for m in msgs[n:]])
+    ctxs[sid] = (txt, len(msgs))
+    return txt
+
+# 系统提示一律用固定常量 (人设、SCRIPT_STYLE_GUIDE、SEMINAR_SYSTEM_PROMPT 等) 放在第 0 条，不拼入任何随请求变化的内容，
+# 这样服务端的前缀缓存 (DeepSeek 自动开启) 每次都能命中；剧本背景、素材之类的上下文放在 user 消息里
+def call_ai_stream(messages, settings, temperature=0.7, max_tokens=None):
+    client = get_openai_client(settings["api_key"], settings["base_url"])
+    extra = {"max_tokens": max_tokens} if max_tokens else {}
+    try: return client.chat.completions.create(model=settings["model_name"], messages=messages, stream=True, temperature=temperature, **extra)
     except Exception as e: return f"Error: {e}"
 
-def call_ai_blocking(prompt, system, settings):
-    client = OpenAI(api_key=settings["api_key"], base_url=settings["base_url"])
-    try: return client.chat.completions.create(model=settings["model_name"], messages=[{"role": "system", "content": system}, {"role": "user", "content": prompt}], temperature=1.0).choices[0].message.content
+def call_ai_blocking(prompt, system, settings, temperature=1.0):
+    client = get_openai_client(settings["api_key"], settings["base_url"])
+    try: return client.chat.completions.create(model=settings["model_name"], messages=[{"role": "system", "content": system}, {"role": "user", "content": prompt}], temperature=temperature).choices[0].message.content
     except Exception as e: return f"Error: {e}"
 
+# 同一会话里 (提示, 系统提示, 服务地址, 模型) 相同时直接复用上次的结果：输入没变时重复点击大纲、精修不再重新生成；
+# 只记在本人的 session_state 里 (最多 AI_MEMO_MAX 条)，大纲、精修这类创作结果不在用户之间共享；出错的结果不记
+# fresh=True 时绕过记录直接请求 (想换一版结果时用)，新结果覆盖旧的
+def call_ai_cached(prompt, system, settings, fresh=False):
+    memo = st.session_state.setdefault("_ai_memo", {}); k = _digest((prompt, system, settings["base_url"], settings["model_name"]))
+    if not fresh and k in memo: return memo[k]
+    res = call_ai_blocking(prompt, system, settings)
+    if not res.startswith("Error:"):
+        memo.pop(k, None); memo[k] = res
+        if len(memo) > AI_MEMO_MAX: memo.pop(next(iter(memo)))
+    return res
+
+# 局部精修用的剧本背景：按剧本内容 (及服务地址、模型) 缓存一份短摘要 (低温度、一小时过期)，同一版本剧本的后续精修共用，不再每次带上 1000 字原文；
+# 摘要只看开头和结尾 (人物、设定与结局)，生成摘要这一次的输入也有上限，不会把整部剧本送出去
+@st.cache_data(ttl=3600, max_entries=16, show_spinner=False)
+def summarize_script(script, base_url, model, _settings):
+    src = script if len(script) <= SCRIPT_SUMMARY_HEAD + SCRIPT_SUMMARY_TAIL else f"{script[:SCRIPT_SUMMARY_HEAD]}\n……\n{script[-SCRIPT_SUMMARY_TAIL:]}"
+    res = call_ai_blocking(f"用200字以内概括这部剧本的标题、人物关系和主要情节，只输出概括：\n{src}", "你是剧本统筹", _settings, temperature=0.3)
+    if res.startswith("Error:"): raise RuntimeError(res)  # 失败不缓存
+    return res
+# 研讨记录分段提炼要点：只做摘录、温度低，按段落内容缓存一小时 (在线程池里运行，没有 session_state 可用)；失败抛出异常，不会被缓存
+@st.cache_data(ttl=3600, max_entries=64, show_spinner=False)
+def _digest_chunk(chunk, base_url, model, _settings):
+    res = call_ai_blocking(f"提炼以下研讨记录里的人物、情节、场景、金句和制片人指示，只输出要点：\n{chunk}", "你是会议记录员", _settings, temperature=0.3)
+    if res.startswith("Error:"): raise RuntimeError(res)
+    return res
+# 研讨纪要的 map 步：放不进预算的早期讨论按段在线程池里并行提炼要点，再交给最终纪要合并 (reduce)，长研讨不会被静默截掉；提炼失败的段落跳过
+def digest_earlier(msgs, settings):
+    chunks = []; cur = []; n = 0
+    for m in msgs:
+        cur.append(f"{m['role']}: {m['content']}"); n += len(m["content"])
+        if n >= SUMMARY_CHUNK_CHARS: chunks.append("\n".join(cur)); cur = []; n = 0
+    if cur: chunks.append("\n".join(cur))
+    jobs = [get_worker_pool().submit(_digest_chunk, c, settings["base_url"], settings["model_name"], settings) for c in chunks]
+    return "\n".join(j.result() for j in jobs if not j.exception())
+
 # ==========================================
 # 6. 主程序逻辑
 # ==========================================
+# 登录成功后写入会话状态 (表单登录和 URL 自动登录共用)
+def start_user_session(u, d):
+    st.session_state.logged_in=True; st.session_state.current_user=u; st.session_state.custom_personas=d.get("personas", {}) or {}
+    st.session_state.history=d.get("sessions") or {}
+    for k in ["current_session_id", "sel_persona"]: st.session_state.pop(k, None)
+
 if "logged_in" not in st.session_state: st.session_state.logged_in=False; st.session_state.current_user=None; st.session_state.custom_personas={}
 if not st.session_state.logged_in and "u" in st.query_params:
-    au = st.query_params["u"]; sb=init_supabase()
-    if sb and sb.table("users").select("*").eq("username", au).execute().data:
-        st.session_state.logged_in=True; st.session_state.current_user=au; st.session_state.custom_personas=sb.table("users").select("*").eq("username", au).execute().data[0].get("personas", {}) or {}; st.toast(f"Hi {au}")
+    au = st.query_params["u"]; s,d=login_user(au)
+    if s: start_user_session(au, d); st.toast(f"Hi {au}")
 
 if not st.session_state.logged_in:
     st.title("🔐 灵感缪斯"); t1,t2=st.tabs(["登录","注册"])
@@ -267,7 +587,7 @@ if not st.session_state.logged_in:
             u=st.text_input("用户"); p=st.text_input("密码", type="password")
             if st.form_submit_button("登录"):
                 s,d=login_user(u,p)
-                if s: st.session_state.logged_in=True; st.session_state.current_user=u; st.session_state.custom_personas=d.get("personas",{}) or {}; st.query_params["u"]=u; st.rerun()
+                if s: start_user_session(u, d); st.query_params["u"]=u; st.rerun()
                 else: st.error("Fail")
     with t2:
         with st.form("r"):
@@ -280,13 +600,64 @@ CURRENT_USER=st.session_state.current_user; SETTINGS=get_settings()
 
 if "history" not in st.session_state:
     with st.spinner("同步中..."): st.session_state.history=load_user_data(CURRENT_USER)
-    for s in st.session_state.history.values():
-        for k in ["article_content", "script_content", "outline_content", "extracted_material", "extracted_analysis"]: 
-            if k not in s: s[k]=""
+
+# 侧边栏的写操作都挂在 on_click 回调上：回调在本轮脚本执行前就改好状态，页面一次画对，不必再额外 st.rerun()
+def new_session(title):
+    nid=str(uuid.uuid4()); nd={"title":title,"messages":[],"article_content":"","script_content":"","outline_content":"","extracted_material":"","extracted_analysis":"","created_at":datetime.now().isoformat()}
+    st.session_state.history={nid: nd, **st.session_state.history}; st.session_state.current_session_id=nid; save_session_db(nid,nd,st.session_state.current_user)
+def save_persona(key):
+    st.session_state.custom_personas[st.session_state[f"pn_{key}"]]=st.session_state[f"pc_{key}"]
+    update_user_personas(st.session_state.current_user, st.session_state.custom_personas)
+def rename_session(sid):
+    curr=st.session_state.history[sid]; nt=st.session_state[f"title_{sid}"]
+    if nt!=curr['title']: curr['title']=nt; save_session_db(sid, curr, st.session_state.current_user); full_rerun()
+def delete_sessions():
+    to_del=st.session_state.del_sids; st.session_state.del_sids=[]
+    for sid in to_del: del st.session_state.history[sid]
+    delete_sessions_db(to_del, st.session_state.current_user)
+    if st.session_state.current_session_id in to_del: st.session_state.current_session_id=None; full_rerun()
+
+# 自定义人设叠在默认人设之上的视图 (同名时自定义优先)，不复制字典；保存人设直接改 custom_personas，视图随之更新
+def merged_personas(): return ChainMap(st.session_state.custom_personas, DEFAULT_PERSONAS)
+def active_persona():
+    all_p=merged_personas(); return all_p.get(st.session_state.get("sel_persona"), next(iter(all_p.values())))
+# 人设面板放进 fragment：切换、编辑、保存人设只重跑这一小块；对话发送时再用 active_persona() 读取当前选择
+@st.fragment
+def persona_panel():
+    all_p=merged_personas()
+    sel_p=st.selectbox("人设", list(all_p.keys()), label_visibility="collapsed", key="sel_persona")
+    with st.expander("⚙️"):
+        st.text_input("名", value=sel_p, key=f"pn_{sel_p}"); st.text_area("内容", value=all_p[sel_p], height=100, key=f"pc_{sel_p}")
+        st.button("保存", on_click=save_persona, args=(sel_p,))
+# 会话列表放进 fragment：勾选要删除的会话、展开更早的会话只重跑侧边栏这一块；
+# 切换、新建、重命名、删掉当前会话会影响主区域，回调里打个标记，由 fragment 触发一次整页 rerun
+def full_rerun(): st.session_state._full_rerun=True
+@st.fragment
+def session_list():
+    if st.session_state.pop("_full_rerun", False): st.rerun()
+    st.button("➕", on_click=lambda: new_session(f"灵感-{datetime.now().strftime('%H:%M')}") or full_rerun())
+    # 一个 radio 选会话 + 一个下拉框删会话，控件数不再随会话数 2K 增长；history 由数据库按创建时间倒序返回，新会话插在最前，无需每次重排
+    sids=list(st.session_state.history)
+    if sids:
+        cur=st.session_state.current_session_id; title_of=lambda s: st.session_state.history[s]['title']
+        # 默认只列最近 SESSION_PAGE 个会话 (当前会话总会列出)，打开开关才列出更早的
+        if len(sids)>SESSION_PAGE and not st.toggle(f"显示更早的 {len(sids)-SESSION_PAGE} 个会话", key="show_old_sessions"):
+            sids=sids[:SESSION_PAGE]+([cur] if cur in st.session_state.history and cur not in sids[:SESSION_PAGE] else [])
+        sel=st.radio("会话", sids, index=sids.index(cur) if cur in sids else None, format_func=title_of, label_visibility="collapsed")
+        if sel and sel!=cur: st.session_state.current_session_id=sel; st.rerun()
+        c1,c2=st.columns([0.8,0.2])
+        to_del=c1.multiselect("删除", sids, format_func=title_of, placeholder="🗑️ 选择要删除的会话", label_visibility="collapsed", key="del_sids")
+        c2.button("x", on_click=delete_sessions, disabled=not to_del)
+    if st.session_state.current_session_id:
+        curr=get_session(st.session_state.current_session_id)
+        # 放进表单：只在提交时写库，而不是每次输入都 upsert 整个会话
+        with st.form("rename"):
+            st.text_input("重命名", value=curr['title'], key=f"title_{st.session_state.current_session_id}")
+            st.form_submit_button("✏️ 保存标题", on_click=rename_session, args=(st.session_state.current_session_id,))
 
 if "current_session_id" not in st.session_state:
     if st.session_state.history: st.session_state.current_session_id=list(st.session_state.history.keys())[0]
-    else: nid=str(uuid.uuid4()); nd={"title":"新会话","messages":[],"article_content":"","script_content":"","outline_content":"","extracted_material":"","extracted_analysis":"","created_at":datetime.now().isoformat()}; st.session_state.history[nid]=nd; st.session_state.current_session_id=nid; save_session_db(nid,nd,CURRENT_USER)
+    else: new_session("新会话")
 
 # --- 侧边栏 ---
 with st.sidebar:
@@ -296,37 +667,21 @@ with st.sidebar:
     app_mode = st.radio("选择", ["💬 对话", "📂 素材提取 (研讨)", "📝 文章", "🎬 剧本Pro"], label_visibility="collapsed")
     st.divider()
     st.header("🎭 人设")
-    all_p={**DEFAULT_PERSONAS, **st.session_state.custom_personas}
-    sel_p=st.selectbox("人设", list(all_p.keys()), label_visibility="collapsed"); act_p=all_p[sel_p]
-    with st.expander("⚙️"):
-        en=st.text_input("名", value=sel_p); ec=st.text_area("内容", value=act_p, height=100)
-        if st.button("保存"): st.session_state.custom_personas[en]=ec; update_user_personas(CURRENT_USER, st.session_state.custom_personas); st.rerun()
+    persona_panel()
     st.divider()
     st.header("🗂️ 会话")
-    if st.button("➕"): nid=str(uuid.uuid4()); nd={"title":f"灵感-{datetime.now().strftime('%H:%M')}","messages":[],"article_content":"","script_content":"","outline_content":"","extracted_material":"","extracted_analysis":"","created_at":datetime.now().isoformat()}; st.session_state.history[nid]=nd; st.session_state.current_session_id=nid; save_session_db(nid,nd,CURRENT_USER); st.rerun()
-    for sid in sorted(list(st.session_state.history.keys()), key=lambda k: st.session_state.history[k]['created_at'], reverse=True):
-        sdata=st.session_state.history[sid]
-        c1,c2=st.columns([0.8,0.2])
-        with c1: 
-            if st.button(f"{'🔵' if sid==st.session_state.current_session_id else '📄'} {sdata['title']}", key=f"b_{sid}", use_container_width=True): st.session_state.current_session_id=sid; st.rerun()
-        with c2:
-            if st.button("x", key=f"d_{sid}"): 
-                del st.session_state.history[sid]; delete_session_db(sid)
-                if sid==st.session_state.current_session_id: st.session_state.current_session_id=None
-                st.rerun()
-    if st.session_state.current_session_id:
-        curr=st.session_state.history[st.session_state.current_session_id]
-        nt=st.text_input("重命名", value=curr['title'])
-        if nt!=curr['title']: curr['title']=nt; save_session_db(st.session_state.current_session_id, curr, CURRENT_USER); st.rerun()
+    session_list()
 
 if not st.session_state.current_session_id: st.stop()
-SESS = st.session_state.history[st.session_state.current_session_id]
+SESS = get_session(st.session_state.current_session_id)
 st.title(SESS['title'])
 
 # === 核心逻辑路由 ===
 
 # === 模式 1: 对话 (含语音编辑功能) ===
-if app_mode == "💬 对话":
+# 放在 fragment 里：录音、发送等交互只重跑聊天区，不再重放侧边栏和整页脚本
+@st.fragment
+def render_chat():
     st.header("💬 灵感对话")
     
     # 0. 初始化语音暂存变量
@@ -334,8 +689,7 @@ if app_mode == "💬 对话":
         st.session_state.voice_draft = ""
 
     # 1. 显示历史记录
-    for m in SESS["messages"]: 
-        with st.chat_message(m["role"]): st.markdown(m["content"])
+    render_history(st.session_state.current_session_id, SESS["messages"])
     
     # 2. 语音录制按钮
     c_mic, c_void = st.columns([0.2, 0.8])
@@ -348,7 +702,7 @@ if app_mode == "💬 对话":
             res_txt = transcribe_mic(audio['bytes'])
             if "❌" not in res_txt and "失败" not in res_txt:
                 st.session_state.voice_draft = res_txt
-                st.rerun() # 强制刷新以显示编辑框
+                st.rerun(scope="fragment") # 强制刷新以显示编辑框
             else:
                 st.error(res_txt)
 
@@ -372,7 +726,7 @@ if app_mode == "💬 对话":
             # 取消发送
             if col_cancel.button("🗑️ 放弃", use_container_width=True):
                 st.session_state.voice_draft = "" # 清空草稿
-                st.rerun()
+                st.rerun(scope="fragment")
     else:
         # --- 普通文本模式 ---
         if p := st.chat_input("输入灵感..."):
@@ -383,23 +737,22 @@ if app_mode == "💬 对话":
         if not SETTINGS["api_key"]: st.error("Secrets未配")
         else:
             SESS["messages"].append({"role": "user", "content": final_input})
-            save_session_db(st.session_state.current_session_id, SESS, CURRENT_USER)
+            append_message_db(st.session_state.current_session_id, SESS, CURRENT_USER)
             
             with st.chat_message("user"): st.markdown(final_input)
             
             with st.chat_message("assistant"):
-                strm = call_ai_stream([{"role":"system","content":act_p}] + SESS["messages"], SETTINGS)
+                strm = call_ai_stream([{"role":"system","content":active_persona()}, *history_tail(st.session_state.current_session_id, SESS["messages"])], SETTINGS)
                 if isinstance(strm, str): st.error(strm)
-                else:
-                    ans = st.write_stream(stream_parser(strm))
-                    SESS["messages"].append({"role": "assistant", "content": ans})
-                    save_session_db(st.session_state.current_session_id, SESS, CURRENT_USER)
+                else: stream_reply(strm, SESS, st.session_state.current_session_id, CURRENT_USER)
             
             # 发送完成后强制刷新，确保状态同步
-            st.rerun()
+            st.rerun(scope="fragment")
 
 # === 升级版：素材研讨会 (三人交互) ===
-elif app_mode == "📂 素材提取 (研讨)":
+# 同样放进 fragment：研讨发言、上传、总结只重跑这一块
+@st.fragment
+def render_seminar():
     st.header("📂 剧本素材研讨会")
     st.info("上传素材 -> 开启研讨 -> 你与两位导师交互讨论 -> 达成共识生成方案")
     
@@ -414,26 +767,26 @@ elif app_mode == "📂 素材提取 (研讨)":
         with st.spinner("解析中..."):
             if "text" in ft or "pdf" in ft or "word" in ft: txt = extract_text_from_file(uploaded_file)
             elif "audio" in ft or "video" in ft: st.info("音频转录中..."); txt = transcribe_audio(uploaded_file)
-            
-            if txt and not txt.startswith("❌"):
+        
+        if txt and not txt.startswith("❌"):
+            # 初始 Prompt：让两位老师先聊一轮
+            init_prompt = f"请两位老师（麦基、王老师）针对以下素材进行第一轮分析：\n{txt[:10000]}"
+            # 生成开场白：流式输出，首个 token 到达就开始显示；请求失败时不写入会话，可以直接重试
+            strm = call_ai_stream([{"role": "system", "content": SEMINAR_SYSTEM_PROMPT}, {"role": "user", "content": init_prompt}], SETTINGS, temperature=1.0)
+            if isinstance(strm, str): st.error(strm)
+            else:
+                with st.chat_message("assistant"): response = stream_to_box(strm)
                 SESS["extracted_material"] = txt
-                # 初始 Prompt：让两位老师先聊一轮
-                init_prompt = f"请两位老师（麦基、王老师）针对以下素材进行第一轮分析：\n{txt[:10000]}"
-                SESS["messages"].append({"role": "user", "content": f"【系统：上传素材】\n{txt[:200]}..."})
-                
-                # 生成开场白
-                response = call_ai_blocking(init_prompt, SEMINAR_SYSTEM_PROMPT, SETTINGS)
-                SESS["messages"].append({"role": "assistant", "content": response})
-                
+                SESS["messages"] += [{"role": "user", "content": f"【系统：上传素材】\n{txt[:200]}..."}, {"role": "assistant", "content": response}]
                 save_session_db(st.session_state.current_session_id, SESS, CURRENT_USER)
-                st.rerun()
-            else: st.error(txt)
+                # 上传区在历史记录上方，仍需在本 fragment 内重跑一次，把开场白挪进下方历史并显示素材预览
+                st.rerun(scope="fragment")
+        else: st.error(txt)
 
     st.divider()
     
     # 3. 研讨会聊天区 (显示历史)
-    for m in SESS["messages"]:
-        with st.chat_message(m["role"]): st.markdown(m["content"])
+    render_history(st.session_state.current_session_id, SESS["messages"])
 
     # 4. 你的发言 (参与讨论)
     if user_input := st.chat_input("发表你的观点，或追问老师..."):
@@ -441,16 +794,15 @@ elif app_mode == "📂 素材提取 (研讨)":
         formatted_input = f"【主编剧/制片人 指示】：{user_input}\n(请两位老师针对我的指示进行反馈，并给出具体的修改建议)"
         
         SESS["messages"].append({"role": "user", "content": formatted_input})
-        save_session_db(st.session_state.current_session_id, SESS, CURRENT_USER)
+        append_message_db(st.session_state.current_session_id, SESS, CURRENT_USER)
         
         # 界面上显示还是显示原始输入，保持美观
         with st.chat_message("user"): st.markdown(user_input)
         
         with st.chat_message("assistant"):
-            strm = call_ai_stream([{"role": "system", "content": SEMINAR_SYSTEM_PROMPT}] + SESS["messages"], SETTINGS)
-            ans = st.write_stream(stream_parser(strm))
-            SESS["messages"].append({"role": "assistant", "content": ans})
-            save_session_db(st.session_state.current_session_id, SESS, CURRENT_USER)
+            strm = call_ai_stream([{"role": "system", "content": SEMINAR_SYSTEM_PROMPT}, *history_tail(st.session_state.current_session_id, SESS["messages"])], SETTINGS)
+            if isinstance(strm, str): st.error(strm)
+            else: stream_reply(strm, SESS, st.session_state.current_session_id, CURRENT_USER)
 
     # 5. 结束按钮 (悬浮或固定在底部)
     st.divider()
@@ -489,39 +841,49 @@ elif app_mode == "📂 素材提取 (研讨)":
 				(直接摘录刚才讨论中出现的精彩台词，或者素材里的原话)
 				"""
                 # 将上下文传给 AI 做总结
-                ctx = [{"role": "system", "content": SEMINAR_SYSTEM_PROMPT}] + SESS["messages"]
+                # 研讨再长也只原样带上最近 SUMMARY_CHAR_BUDGET 字的对话，更早的部分先压成要点，超出上下文窗口时不至于整个请求被拒
+                recent = within_budget(SESS["messages"], SUMMARY_CHAR_BUDGET); ctx = [{"role": "system", "content": SEMINAR_SYSTEM_PROMPT}]
+                if len(recent) < len(SESS["messages"]):
+                    status.write("压缩早期讨论..."); early = digest_earlier(SESS["messages"][:-len(recent)], SETTINGS)
+                    if early: ctx.append({"role": "user", "content": f"【早期讨论要点】\n{early}"})
+                ctx += recent
                 ctx.append({"role": "user", "content": summary_prompt})
                 
-                # 修正：直接用 messages 调用 non-stream
-                client = OpenAI(api_key=SETTINGS["api_key"], base_url=SETTINGS["base_url"])
-                final_res = client.chat.completions.create(model=SETTINGS["model_name"], messages=ctx, temperature=0.7).choices[0].message.content
+                # 纪要改为流式写进状态框，首个 token 到达就开始显示，不再干等整段生成完；出错时不写入会话
+                strm = call_ai_stream(ctx, SETTINGS)
+                if isinstance(strm, str): status.update(label=strm, state="error")
+                else:
+                    final_res = stream_to_box(strm)
                 
-                SESS["extracted_analysis"] = final_res
-                # 也可以把总结结果存入对话流，作为结尾
-                SESS["messages"].append({"role": "assistant", "content": f"### 📝 最终会议总结\n{final_res}"})
-                save_session_db(st.session_state.current_session_id, SESS, CURRENT_USER)
+                    SESS["extracted_analysis"] = final_res
+                    # 也可以把总结结果存入对话流，作为结尾
+                    SESS["messages"].append({"role": "assistant", "content": f"### 📝 最终会议总结\n{final_res}"})
+                    save_session_db(st.session_state.current_session_id, SESS, CURRENT_USER)
                 
-                status.update(label="开发案已生成！已自动填入【剧本Pro】", state="complete")
-                st.rerun()
+                    # 纪要已经流式显示在状态框里，不再 rerun 重画整段历史；下次交互时它会作为最后一条消息出现在历史中
+                    status.update(label="开发案已生成！已自动填入【剧本Pro】", state="complete")
 
-elif app_mode == "📝 文章":
+# === 模式 3/4: 文章、剧本 ===
+# 同样各自放进 fragment：生成、精修、开关切换只重跑本模式
+@st.fragment
+def render_article():
     st.header("📝 文章生成")
     if SESS["article_content"]: st.success("已存档"); st.code(SESS["article_content"], language="markdown")
     if st.button("生成/重写"):
         if not SESS["messages"]: st.warning("空")
         else:
             with st.status("撰写中..."):
-                ctx = "\n".join([f"{m['role']}: {m['content']}" for m in SESS["messages"]])
+                ctx = chat_context(st.session_state.current_session_id, SESS["messages"])
                 strm = call_ai_stream([{"role": "system", "content": "你是编辑"}, {"role": "user", "content": f"整理文章:\n{ctx}"}], SETTINGS)
-                bx = st.empty(); ft = ""
-                for c in stream_parser(strm): ft+=c; bx.markdown(ft+"▌")
-                bx.markdown(ft); SESS["article_content"]=ft; save_session_db(st.session_state.current_session_id, SESS, CURRENT_USER)
+                ft = stream_to_box(strm); SESS["article_content"]=ft; save_session_db(st.session_state.current_session_id, SESS, CURRENT_USER)
 
-elif app_mode == "🎬 剧本Pro":
+@st.fragment
+def render_script():
     st.header("🎬 剧本创作 Pro")
-    c1, c2 = st.columns(2)
+    c1, c2, c3 = st.columns(3)
     with c1: u_out = st.toggle("大纲模式", value=False)
     with c2: u_ma = st.toggle("多智能体", value=False)
+    with c3: u_fresh = st.toggle("跳过缓存", value=False, help="相同输入也重新生成大纲/精修结果")
 
     default_plot_val = ""
     if SESS.get("extracted_analysis"):
@@ -539,27 +901,25 @@ elif app_mode == "🎬 剧本Pro":
         extra = st.text_input("补充")
         sub_base = st.form_submit_button("生成大纲" if u_out else "生成剧本")
 
-    ctx_str = "\n".join([f"{m['role']}: {m['content']}" for m in SESS["messages"]]) if SESS["messages"] else ""
-    if SESS.get("extracted_material"): ctx_str += f"\n\n【素材】:\n{SESS['extracted_material'][:5000]}"
-
     if sub_base:
+        ctx_str = chat_context(st.session_state.current_session_id, SESS["messages"])
+        if SESS.get("extracted_material"): ctx_str += f"\n\n【素材】:\n{SESS['extracted_material'][:5000]}"
         if u_out:
             with st.status("生成大纲..."):
-                res = call_ai_blocking(f"背景:{ctx_str}\n主题:{thm}\n人物:{chars}\n情节:{plot}\n要求:生成Beat Sheet", "你是策划", SETTINGS)
-                SESS["outline_content"] = res; save_session_db(st.session_state.current_session_id, SESS, CURRENT_USER); st.rerun()
+                res = call_ai_cached(f"背景:{ctx_str}\n主题:{thm}\n人物:{chars}\n情节:{plot}\n要求:生成Beat Sheet", "你是策划", SETTINGS, u_fresh)
+                SESS["outline_content"] = res; save_session_db(st.session_state.current_session_id, SESS, CURRENT_USER); st.rerun(scope="fragment")
         else:
             final_p = f"背景:{ctx_str}\n主题:{thm}\n人物:{chars}\n场景:{scene}\n情节:{plot}\n补充:{extra}"
-            if u_ma:
-                with st.status("多智能体...") as s:
-                    s.write("起草..."); d = call_ai_blocking(final_p, SCRIPT_STYLE_GUIDE, SETTINGS)
-                    s.write("审稿..."); c = call_ai_blocking(f"批评:\n{d}", "毒舌审稿", SETTINGS)
-                    s.write("修正..."); final_p = f"原稿:\n{d}\n意见:\n{c}\n重写:"
-                    s.update(label="完成", state="complete")
             st.markdown("### 剧本")
-            strm = call_ai_stream([{"role": "system", "content": SCRIPT_STYLE_GUIDE}, {"role": "user", "content": final_p}], SETTINGS)
-            bx = st.empty(); ft = ""
-            for c in stream_parser(strm): ft+=c; bx.markdown(ft+"▌")
-            bx.markdown(ft); SESS["script_content"]=ft; save_session_db(st.session_state.current_session_id, SESS, CURRENT_USER)
+            # 多智能体的初稿、审稿和定稿共用一次输出，放宽到 MULTI_AGENT_MAX_TOKENS，免得默认上限把 <final> 截断
+            strm = call_ai_stream([{"role": "system", "content": MULTI_AGENT_GUIDE if u_ma else SCRIPT_STYLE_GUIDE}, {"role": "user", "content": final_p}], SETTINGS, max_tokens=MULTI_AGENT_MAX_TOKENS if u_ma else None)
+            if isinstance(strm, str): st.error(strm); ft = None
+            elif u_ma:
+                try:
+                    with st.spinner("多智能体起草、审稿中，定稿随后流式输出..."): ft = stream_to_box(strm, "final")
+                except ValueError: st.error("定稿没有完整输出 (可能超出长度上限)，本次结果未保存，请精简要求后重试"); ft = None
+            else: ft = stream_to_box(strm)
+            if ft: SESS["script_content"]=ft; save_session_db(st.session_state.current_session_id, SESS, CURRENT_USER)
 
     if u_out and SESS["outline_content"]:
         st.divider(); st.subheader("确认大纲")
@@ -568,9 +928,7 @@ elif app_mode == "🎬 剧本Pro":
             fp = f"大纲:\n{new_out}\n要求:{extra}"
             st.markdown("### 剧本")
             strm = call_ai_stream([{"role": "system", "content": SCRIPT_STYLE_GUIDE}, {"role": "user", "content": fp}], SETTINGS)
-            bx = st.empty(); ft = ""
-            for c in stream_parser(strm): ft+=c; bx.markdown(ft+"▌")
-            bx.markdown(ft); SESS["script_content"]=ft; save_session_db(st.session_state.current_session_id, SESS, CURRENT_USER)
+            ft = stream_to_box(strm); SESS["script_content"]=ft; save_session_db(st.session_state.current_session_id, SESS, CURRENT_USER)
 
     if SESS["script_content"]:
         st.divider(); st.success("完成")
@@ -584,5 +942,19 @@ elif app_mode == "🎬 剧本Pro":
             if st.form_submit_button("修改"):
                 with st.spinner("修改中..."):
                     p_refine = f"原片段:\n{target}\n意见:\n{instr}\n请仅输出修改后的片段。"
-                    res_refine = call_ai_blocking(p_refine, f"剧本助手。背景:\n{SESS['script_content'][:1000]}", SETTINGS)
-                    st.markdown("### 结果"); st.code(res_refine, language="markdown")
\ No newline at end of file
+                    # 同一版本剧本的前 REFINE_SUMMARY_AFTER 次精修照旧带开头 1000 字，多一次摘要调用不划算；再往后才算一次摘要，之后都只带摘要
+                    scr = SESS["script_content"]; h = _digest(scr); cnt = st.session_state.setdefault("_refine_n", {}); cnt[h] = cnt.get(h, 0) + 1; bg = scr[:1000]
+                    if cnt[h] > REFINE_SUMMARY_AFTER:
+                        try: bg = summarize_script(scr, SETTINGS["base_url"], SETTINGS["model_name"], SETTINGS)
+                        except Exception: pass
+                    res_refine = call_ai_cached(f"背景:\n{bg}\n{p_refine}", "剧本助手", SETTINGS, u_fresh)
+                    st.markdown("### 结果"); st.code(res_refine, language="markdown")
+
+if app_mode == "💬 对话":
+    render_chat()
+elif app_mode == "📂 素材提取 (研讨)":
+    render_seminar()
+elif app_mode == "📝 文章":
+    render_article()
+elif app_mode == "🎬 剧本Pro":
+    render_script()
\ No newline at end of file
@@ -0,0 +1,53 @@
+-- lalamuse 所需的 Supabase 函数，在 SQL Editor 中执行一次即可
+
+-- 登录：一次往返取回用户、口令摘要与会话列表 (只含标题/创建时间，按创建时间倒序)；只按用户名查，口令由应用端比对
+-- with_password 为 false (URL 自动登录) 时不返回口令摘要
+drop function if exists get_user_bundle(text, text);
+drop function if exists get_user_bundle(text);
+create or replace function get_user_bundle(uname text, with_password boolean default false)
+returns json language sql stable as $$
+  select json_build_object(
+    'username', u.username,
+    'password', case when with_password then u.password end,
+    'personas', coalesce(u.personas, '{}'::jsonb),
+    'sessions', coalesce((select json_object_agg(c.id, json_build_object('title', c.data->>'title', 'created_at', c.data->>'created_at') order by c.data->>'created_at' desc) from chat_history c where c.username = u.username), '{}'::json)
+  )
+  from users u
+  where u.username = uname;
+$$;
+
+
+-- 聊天：只把新增消息追加到 data->messages，避免每轮重传整个会话；只改本人的会话，没追加到 (会话不存在) 时返回 false，由应用端改为整段 upsert
+drop function if exists append_messages(chat_history.id%type, jsonb);
+create or replace function append_messages(sid chat_history.id%type, uname text, msgs jsonb)
+returns boolean language sql as $$
+  with u as (
+    update chat_history
+    set data = jsonb_set(data, '{messages}', coalesce(data->'messages', '[]'::jsonb) || msgs)
+    where id = sid and username = uname
+    returning 1
+  )
+  select exists (select 1 from u);
+$$;
+
+-- 保存文章/大纲/剧本/标题：只把改动过的顶层字段合并进 data，不再整段重传消息历史；会话不存在时返回 false，由应用端改为整段 upsert
+create or replace function patch_session(sid chat_history.id%type, uname text, patch jsonb)
+returns boolean language sql as $$
+  with u as (update chat_history set data = data || patch where id = sid and username = uname returning 1)
+  select exists (select 1 from u);
+$$;
+
+-- 人设与会话一起保存：更新 users.personas 并 upsert 一批会话，同一个事务里完成
+create or replace function save_user_bundle(uname text, pers jsonb, sess jsonb)
+returns void language sql as $$
+  update users set personas = pers where username = uname;
+  insert into chat_history (id, username, data)
+  select r.id, r.username, r.data from jsonb_populate_recordset(null::chat_history, sess) r
+  on conflict (id) do update set username = excluded.username, data = excluded.data;
+$$;
+
+-- 会话列表按用户过滤、按创建时间倒序：用表达式索引支撑，避免每次登录都全表排序
+create index if not exists chat_history_username_created_at_idx on chat_history (username, (data->>'created_at') desc);
+
+-- 注册：直接插入并依赖用户名唯一约束判重 (username 已是主键时这条可以跳过)
+create unique index if not exists users_username_key on users (username);